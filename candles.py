@@ -0,0 +1,41 @@
+"""Historical candle decoding, kept free of import-time side effects.
+
+The fork server preloads only this module, and parser processes unpickle
+parse_candles from here rather than importing market_data_service again.
+"""
+from datetime import datetime
+from typing import Dict, Any
+
+import numpy as np
+import orjson
+
+CANDLE_DTYPES = {"ts": np.int64, "o": np.float32, "h": np.float32, "l": np.float32, "c": np.float32, "v": np.int64}
+
+def parse_candles(content: bytes) -> Dict[str, Any]:
+    """Decode a historical candle response into typed NumPy columns.
+
+    Runs in the parser process for large responses. Rows of
+    [timestamp, open, high, low, close, volume] become epoch-second
+    timestamps, float32 prices and int64 volumes.
+    """
+    data = orjson.loads(content)
+    rows = data.get("data") if data.get("status") else None
+    if rows:
+        # Transposed copy so each price column is C-contiguous for orjson
+        o, h, l, c = np.array([row[1:5] for row in rows], dtype=np.float32).T.copy()
+        data["data"] = {
+            "ts": np.fromiter((int(datetime.fromisoformat(row[0]).timestamp()) for row in rows),
+                              dtype=np.int64, count=len(rows)),
+            "o": o,
+            "h": h,
+            "l": l,
+            "c": c,
+            "v": np.array([row[5] for row in rows], dtype=np.int64)
+        }
+    return data
+
+def columns_from_cache(value: Any) -> Any:
+    """Rebuild the typed candle columns from their JSON lists after a Redis cache hit."""
+    if not isinstance(value, dict):
+        return value
+    return {name: np.array(value[name], dtype=dtype) for name, dtype in CANDLE_DTYPES.items()}
@@ -1,58 +1,247 @@
 import os
 import asyncio
 import logging
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener
 import redis
-import requests
+from redis import asyncio as aioredis
+import httpx
 import pyotp
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+import base64
+import threading
+import socket
+import time
+import functools
+import hashlib
+import orjson
+import msgpack
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, Response
 from dotenv import load_dotenv
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Callable, Awaitable, Union
 from contextlib import asynccontextmanager
 from fastapi.staticfiles import StaticFiles
+from SmartApi.smartWebSocketV2 import SmartWebSocketV2
+from candles import parse_candles, columns_from_cache
 
 # Load environment variables
 load_dotenv()
 
 # Logger Setup
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler("logs/market_data_service.log"),
-        logging.StreamHandler()
-    ]
-)
+def setup_logging() -> None:
+    """Send all records through a queue to one background listener thread, once per process.
+
+    uvicorn's spawned workers execute this file twice (as __mp_main__, then as
+    market_data_service), so a second call must not add handlers again.
+    """
+    root_logger = logging.getLogger()
+    if any(isinstance(handler, QueueHandler) for handler in root_logger.handlers):
+        return
+    log_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    file_handler = logging.FileHandler("logs/market_data_service.log")
+    file_handler.setFormatter(log_formatter)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(log_formatter)
+    log_queue = queue.SimpleQueue()
+    log_listener = QueueListener(log_queue, file_handler, stream_handler)
+    # Tied to the process, not to lifespan, which may run more than once per process
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    # On the root logger, like basicConfig before, so library logs reach the same file
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(QueueHandler(log_queue))
+
+setup_logging()
 logger = logging.getLogger("MarketDataService")
 
-# Global auth instance
+# Global auth instance and shared market data feed
 auth_client = None
+market_feed = None
+
+# Redis writes are queued from the WebSocket hot path and flushed in batches
+REDIS_FLUSH_INTERVAL = 0.05  # seconds
+REDIS_BATCH_SIZE = 100
+REDIS_TTL = 5  # seconds
+redis_write_queue: asyncio.Queue = asyncio.Queue()
+
+# With several workers only the leader holds the broker feed; ticks reach the others over Pub/Sub
+FEED_CHANNEL = "market_data:ticks"
+FEED_LEADER_KEY = "market_data:feed_leader"
+FEED_LEADER_TTL = 15  # seconds
+FEED_RETRY_DELAY = 1  # seconds before a dropped Pub/Sub subscription is retried
+PUBLISH_ERROR_LOG_INTERVAL = 30  # seconds between repeated tick publish error logs
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}".encode()
+
+# Historical responses larger than this are decoded in a worker process, off the GIL.
+# Below it, inline decoding blocks the loop for under ~1.5 ms and IPC latency is not worth it.
+HISTORICAL_OFFLOAD_BYTES = 64 * 1024
+
+# How long the ETag of a historical query is remembered for conditional requests
+HISTORICAL_ETAG_TTL = 60  # seconds
+
+# Clients that cannot take a frame within this window are treated as dead
+WS_SEND_TIMEOUT = 5  # seconds
+# Ticks buffered per client before it is considered too slow and dropped
+CLIENT_QUEUE_SIZE = 8
+
+def new_parse_pool() -> ProcessPoolExecutor:
+    """Process pool for decoding large historical responses.
+
+    One parser per uvicorn worker: the workers already cover every core, so more would
+    only oversubscribe. forkserver avoids forking a process that runs the log, feed and
+    loop threads, and preloading only the candles module keeps the fork server from
+    executing this script.
+    """
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["candles"])
+    return ProcessPoolExecutor(max_workers=1, mp_context=context)
 
 # Lifespan event handler
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Handle startup and shutdown events."""
-    global auth_client
+    global auth_client, market_feed, redis_client
+    redis_tasks = []
     try:
+        try:
+            await redis_client.ping()  # Test connection
+        except redis.ConnectionError as e:
+            logger.warning(f"Redis not available: {e}. Proceeding without Redis.")
+            await redis_client.aclose()
+            redis_client = None
         auth_client = AngelOneAuth()
-        auth_client.login()
+        auth_client.parse_pool = new_parse_pool()
+        auth_client.http = httpx.AsyncClient(
+            base_url=auth_client.base_url,
+            timeout=10.0,
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                retries=2,  # Connect failures only, so order POSTs are never replayed
+                limits=httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=60.0)
+            )
+        )
+        # Each worker keeps its own session for the trading day; tokens are not refreshed in place,
+        # since the broker WebSocket would also have to be re-authenticated with the new feed token
+        await auth_client.login()
         if not auth_client.jwt_token:
             raise RuntimeError("Authentication failed")
-        logger.info("Application startup complete")
+        if redis_client:
+            redis_tasks = [
+                asyncio.create_task(redis_writer()),
+                asyncio.create_task(relay_ticks()),
+                asyncio.create_task(lead_market_feed())
+            ]
+        else:
+            market_feed = MarketFeed(auth_client, manager)
+            market_feed.start(asyncio.get_running_loop())
+        logger.info(f"Application startup complete (worker {os.getpid()})")
         yield
     finally:
+        for task in redis_tasks:
+            task.cancel()
+        await asyncio.gather(*redis_tasks, return_exceptions=True)
+        if market_feed:
+            await market_feed.stop()
+        await manager.close_all()
         if auth_client:
-            auth_client.logout()
+            await auth_client.logout()
             logger.info("Application shutdown: Logged out from Angel One API")
+            if auth_client.http:
+                await auth_client.http.aclose()
+            if auth_client.parse_pool:
+                auth_client.parse_pool.shutdown(wait=False, cancel_futures=True)
+        if redis_client:
+            await redis_client.aclose()
 
 # Initialize FastAPI app with lifespan
 app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static", check_dir=False), name="static")  # Avoid error if folder missing
-try:
-    redis_client = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
-    redis_client.ping()  # Test connection
-except redis.ConnectionError as e:
-    logger.warning(f"Redis not available: {e}. Proceeding without Redis.")
-    redis_client = None
+# Connections are opened lazily; lifespan pings and drops the client if Redis is down
+redis_client = aioredis.Redis(host='localhost', port=6379, db=0, decode_responses=False, max_connections=50)
+
+# Leadership is only renewed or released by the worker that still holds it, atomically
+renew_feed_leader = redis_client.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+""")
+release_feed_leader = redis_client.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+def cached(ttl: int, key_fn: Callable[..., str], maxsize: int = 256,
+           decode: Optional[Callable[[Any], Any]] = None):
+    """Cache successful method results in-process and in Redis for `ttl` seconds.
+
+    `key_fn` is called with the same arguments as the method, `self` included.
+    `decode` restores types that do not survive the JSON round trip through Redis.
+    """
+    def decorator(func):
+        local: "OrderedDict[str, tuple]" = OrderedDict()
+
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            key = key_fn(self, *args, **kwargs)
+            now = time.monotonic()
+            hit = local.get(key)
+            if hit and hit[0] > now:
+                local.move_to_end(key)
+                return hit[1]
+
+            value = None
+            expires_at = now + ttl
+            if redis_client:
+                try:
+                    pipe = redis_client.pipeline(transaction=False)
+                    pipe.get(key)
+                    pipe.pttl(key)
+                    raw, remaining_ms = await pipe.execute()
+                    if raw is not None:
+                        value = orjson.loads(raw)
+                        if decode:
+                            value = decode(value)
+                        if remaining_ms > 0:
+                            # Expire locally together with the Redis copy, not a full ttl later
+                            expires_at = now + remaining_ms / 1000
+                except redis.RedisError as e:
+                    logger.warning(f"Cache read failed for {key}: {e}")
+            if value is None:
+                value = await func(self, *args, **kwargs)
+                if value is None:
+                    return None  # Never cache failures
+                if redis_client:
+                    try:
+                        await redis_client.setex(key, ttl, orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY))
+                    except redis.RedisError as e:
+                        logger.warning(f"Cache write failed for {key}: {e}")
+
+            local[key] = (expires_at, value)
+            local.move_to_end(key)
+            if len(local) > maxsize:
+                local.popitem(last=False)
+            return value
+        return wrapper
+    return decorator
+
+def _short_body(response: httpx.Response, limit: int = 512) -> str:
+    """First `limit` bytes of a response body, decoded for logging."""
+    return response.content[:limit].decode("utf-8", "replace")
+
+@functools.lru_cache(maxsize=128)
+def _ltp_body(exchange: str, tradingsymbol: str, symboltoken: str) -> bytes:
+    """JSON body for an LTP quote, encoded once per instrument."""
+    return orjson.dumps({
+        "mode": "LTP",
+        "data": [{"exchange": exchange, "tradingsymbol": tradingsymbol, "symboltoken": symboltoken}]
+    })
 
 # Angel One Authentication Class
 class AngelOneAuth:
@@ -68,17 +257,21 @@ class AngelOneAuth:
             raise ValueError("Missing required credentials in .env file")
 
         try:
-            pyotp.TOTP(self.otp_token).now()
-        except Exception:
+            # Secrets are usually stored unpadded; pad like pyotp does before decoding
+            base64.b32decode(self.otp_token + "=" * (-len(self.otp_token) % 8), casefold=True)
+        except ValueError:  # binascii.Error, or non-ASCII input
             logger.critical("Invalid OTP_TOKEN format in .env file")
             raise ValueError("Invalid OTP_TOKEN format in .env file")
+        self._totp = pyotp.TOTP(self.otp_token)
 
         self.refresh_token = None
         self.feed_token = None
         self.jwt_token = None
+        self.http: Optional[httpx.AsyncClient] = None  # Set up in lifespan
+        self.parse_pool: Optional[ProcessPoolExecutor] = None  # Set up in lifespan
 
-    def _get_headers(self) -> Dict[str, str]:
-        return {
+        # Headers are constant apart from the token, so build them once
+        self._static_headers = {
             "Content-Type": "application/json",
             "Accept": "application/json",
             "X-UserType": "USER",
@@ -86,26 +279,57 @@ class AngelOneAuth:
             "X-ClientLocalIP": "127.0.0.1",
             "X-ClientPublicIP": "your_public_ip",  # Replace with actual IP if needed
             "X-MACAddress": "00:00:00:00:00:00",
-            "X-PrivateKey": self.api_key,
-            "Authorization": f"Bearer {self.jwt_token}" if self.jwt_token else ""
+            "X-PrivateKey": self.api_key
         }
+        self._headers: Dict[str, str] = {**self._static_headers, "Authorization": ""}
+        self._inflight: Dict[tuple, asyncio.Future] = {}
 
-    def login(self) -> Optional[Dict[str, Any]]:
+    async def _single_flight(self, key: tuple, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """Share one upstream call between concurrent callers asking for the same key."""
+        future = self._inflight.get(key)
+        if future:
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise  # This caller was cancelled itself
+                # The caller doing the fetch was cancelled; start over rather than propagate it
+                return await self._single_flight(key, fetch)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
         try:
-            totp = pyotp.TOTP(self.otp_token).now()
+            result = await fetch()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Mark retrieved so an unawaited future doesn't warn
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+    async def login(self) -> Optional[Dict[str, Any]]:
+        try:
+            totp = self._totp.now()
             payload = {
                 "clientcode": self.user_id,
                 "password": self.mpin,
                 "totp": totp
             }
-            response = requests.post(
-                f"{self.base_url}/rest/auth/angelbroking/user/v1/loginByPassword",
+            response = await self.http.post(
+                "/rest/auth/angelbroking/user/v1/loginByPassword",
                 json=payload,
-                headers=self._get_headers()
+                headers=self._headers
             )
-            session = response.json()
+            session = orjson.loads(response.content)
             if response.status_code == 200 and session.get("status"):
                 self.jwt_token = session["data"]["jwtToken"]
+                self._headers = {**self._static_headers, "Authorization": f"Bearer {self.jwt_token}"}
                 self.refresh_token = session["data"]["refreshToken"]
                 self.feed_token = session["data"]["feedToken"]
                 logger.info("Successfully logged into Angel One API")
@@ -117,16 +341,18 @@ class AngelOneAuth:
             logger.critical(f"Authentication Error: {e}", exc_info=True)
             return None
 
-    def logout(self) -> Optional[Dict[str, Any]]:
+    async def logout(self) -> Optional[Dict[str, Any]]:
         try:
             payload = {"clientcode": self.user_id}
-            response = requests.post(
-                f"{self.base_url}/rest/secure/angelbroking/user/v1/logout",
+            response = await self.http.post(
+                "/rest/secure/angelbroking/user/v1/logout",
                 json=payload,
-                headers=self._get_headers()
+                headers=self._headers
             )
-            result = response.json()
+            result = orjson.loads(response.content)
             if response.status_code == 200 and result.get("status"):
+                self.jwt_token = None
+                self._headers = {**self._static_headers, "Authorization": ""}
                 logger.info("Successfully logged out.")
                 return result
             else:
@@ -136,28 +362,38 @@ class AngelOneAuth:
             logger.error(f"Logout Error: {e}", exc_info=True)
             return None
 
-    def get_ltp_data(self, exchange: str, tradingsymbol: str, symboltoken: str) -> Optional[Dict[str, Any]]:
+    async def get_ltp_data(self, exchange: str, tradingsymbol: str, symboltoken: str) -> Optional[Dict[str, Any]]:
+        return await self._single_flight(
+            ("ltp", exchange, tradingsymbol, symboltoken),
+            lambda: self._fetch_ltp_data(exchange, tradingsymbol, symboltoken)
+        )
+
+    async def _fetch_ltp_data(self, exchange: str, tradingsymbol: str, symboltoken: str) -> Optional[Dict[str, Any]]:
         try:
-            payload = {
-                "exchange": exchange,
-                "tradingsymbol": tradingsymbol,
-                "symboltoken": symboltoken
-            }
-            response = requests.post(
-                f"{self.base_url}/rest/secure/angelbroking/market/v1/quote",
-                json={"mode": "LTP", "data": [payload]},
-                headers=self._get_headers()
+            response = await self.http.post(
+                "/rest/secure/angelbroking/market/v1/quote",
+                content=_ltp_body(exchange, tradingsymbol, symboltoken),
+                headers=self._headers
             )
-            data = response.json()
+            data = orjson.loads(response.content)
             if response.status_code == 200 and data.get("status"):
                 return data["data"]["fetched"][0]
-            logger.error(f"LTP fetch failed: {data.get('message', 'Unknown error')} - Response: {response.text}")
+            logger.error(f"LTP fetch failed: {data.get('message', 'Unknown error')} - Response: {_short_body(response)}")
             return None
         except Exception as e:
             logger.error(f"LTP Data Error: {e}", exc_info=True)
             return None
 
-    def get_historical_data(self, exchange: str, symboltoken: str, interval: str, fromdate: str, todate: str) -> Optional[Dict[str, Any]]:
+    @cached(ttl=30, key_fn=lambda self, exchange, symboltoken, interval, fromdate, todate:
+            f"hist:{exchange}:{symboltoken}:{interval}:{fromdate}:{todate}",
+            decode=columns_from_cache)
+    async def get_historical_data(self, exchange: str, symboltoken: str, interval: str, fromdate: str, todate: str) -> Optional[Dict[str, Any]]:
+        return await self._single_flight(
+            ("historical", exchange, symboltoken, interval, fromdate, todate),
+            lambda: self._fetch_historical_data(exchange, symboltoken, interval, fromdate, todate)
+        )
+
+    async def _fetch_historical_data(self, exchange: str, symboltoken: str, interval: str, fromdate: str, todate: str) -> Optional[Dict[str, Any]]:
         try:
             payload = {
                 "exchange": exchange,
@@ -166,66 +402,300 @@ class AngelOneAuth:
                 "fromdate": fromdate,
                 "todate": todate
             }
-            response = requests.get(
-                f"{self.base_url}/rest/secure/angelbroking/historical/v1/getCandleData",
+            response = await self.http.get(
+                "/rest/secure/angelbroking/historical/v1/getCandleData",
                 params=payload,
-                headers=self._get_headers()
+                headers=self._headers
             )
-            data = response.json()
+            pool = self.parse_pool
+            if pool and len(response.content) > HISTORICAL_OFFLOAD_BYTES:
+                try:
+                    data = await asyncio.get_running_loop().run_in_executor(pool, parse_candles, response.content)
+                except BrokenProcessPool:
+                    # The parser died (e.g. OOM); replace the pool once and decode this response inline
+                    if self.parse_pool is pool:
+                        logger.error("Candle parser process died, recreating the pool")
+                        pool.shutdown(wait=False, cancel_futures=True)
+                        self.parse_pool = new_parse_pool()
+                    data = parse_candles(response.content)
+            else:
+                data = parse_candles(response.content)
             if response.status_code == 200 and data.get("status"):
                 return data["data"]
-            logger.error(f"Historical data fetch failed: {data.get('message', 'Unknown error')} - Response: {response.text}")
+            logger.error(f"Historical data fetch failed: {data.get('message', 'Unknown error')} - Response: {_short_body(response)}")
             return None
         except Exception as e:
             logger.error(f"Historical Data Error: {e}", exc_info=True)
             return None
 
-    def place_order(self, orderparams: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    async def place_order(self, orderparams: Union[Dict[str, Any], bytes]) -> Optional[Dict[str, Any]]:
+        """Place an order; `orderparams` may be passed pre-encoded as JSON bytes."""
         try:
-            response = requests.post(
-                f"{self.base_url}/rest/secure/angelbroking/order/v1/placeOrder",
-                json=orderparams,
-                headers=self._get_headers()
+            response = await self.http.post(
+                "/rest/secure/angelbroking/order/v1/placeOrder",
+                content=orderparams if isinstance(orderparams, bytes) else orjson.dumps(orderparams),
+                headers=self._headers
             )
-            data = response.json()
+            data = orjson.loads(response.content)
             if response.status_code == 200 and data.get("status"):
                 return data["data"]
-            logger.error(f"Order placement failed: {data.get('message', 'Unknown error')} - Response: {response.text}")
+            logger.error(f"Order placement failed: {data.get('message', 'Unknown error')} - Response: {_short_body(response)}")
             return None
         except Exception as e:
             logger.error(f"Order Placement Error: {e}", exc_info=True)
             return None
 
-    def get_order_book(self) -> Optional[Dict[str, Any]]:
+    async def get_order_book(self) -> Optional[Dict[str, Any]]:
         try:
-            response = requests.get(
-                f"{self.base_url}/rest/secure/angelbroking/order/v1/getOrderBook",
-                headers=self._get_headers()
+            response = await self.http.get(
+                "/rest/secure/angelbroking/order/v1/getOrderBook",
+                headers=self._headers
             )
-            data = response.json()
+            data = orjson.loads(response.content)
             if response.status_code == 200 and data.get("status"):
                 return data["data"]
-            logger.error(f"Order book fetch failed: {data.get('message', 'Unknown error')} - Response: {response.text}")
+            logger.error(f"Order book fetch failed: {data.get('message', 'Unknown error')} - Response: {_short_body(response)}")
             return None
         except Exception as e:
             logger.error(f"Order Book Error: {e}", exc_info=True)
             return None
 
-    def get_profile(self) -> Optional[Dict[str, Any]]:
+    @cached(ttl=30, key_fn=lambda self: f"profile:{self.user_id}")
+    async def get_profile(self) -> Optional[Dict[str, Any]]:
         try:
-            response = requests.get(
-                f"{self.base_url}/rest/secure/angelbroking/user/v1/getProfile",
-                headers=self._get_headers()
+            response = await self.http.get(
+                "/rest/secure/angelbroking/user/v1/getProfile",
+                headers=self._headers
             )
-            data = response.json()
+            data = orjson.loads(response.content)
             if response.status_code == 200 and data.get("status"):
                 return data["data"]
-            logger.error(f"Profile fetch failed: {data.get('message', 'Unknown error')} - Response: {response.text}")
+            logger.error(f"Profile fetch failed: {data.get('message', 'Unknown error')} - Response: {_short_body(response)}")
             return None
         except Exception as e:
             logger.error(f"Profile Error: {e}", exc_info=True)
             return None
 
+# Fan-out of live ticks to connected WebSocket clients
+class ConnectionManager:
+    def __init__(self):
+        self.active: Dict[WebSocket, asyncio.Queue] = {}
+
+    def connect(self, websocket: WebSocket) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE)
+        self.active[websocket] = queue
+        return queue
+
+    def disconnect(self, websocket: WebSocket) -> None:
+        self.active.pop(websocket, None)
+
+    def _drop(self, websocket: WebSocket) -> None:
+        """Unregister a client and wake its handler with a None close signal."""
+        queue = self.active.pop(websocket, None)
+        if queue is None:
+            return
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    async def close(self, websocket: WebSocket) -> None:
+        """Drop a client and close its socket without waiting on a dead peer."""
+        self._drop(websocket)
+        try:
+            await asyncio.wait_for(websocket.close(), WS_SEND_TIMEOUT)
+        except Exception:
+            pass  # Peer is already gone
+
+    async def close_all(self) -> None:
+        await asyncio.gather(*(self.close(websocket) for websocket in list(self.active)))
+
+    async def watch(self, websocket: WebSocket) -> None:
+        """Read until the peer disconnects or misses uvicorn's pings, then wake its handler.
+
+        Without this a dead client would only be noticed on the next send, and there
+        are no ticks outside market hours.
+        """
+        try:
+            while (await websocket.receive())["type"] != "websocket.disconnect":
+                pass  # Client messages are not used
+            logger.info("WebSocket client disconnected")
+        except Exception as e:
+            logger.warning(f"WebSocket receive failed: {e}")
+        self._drop(websocket)
+
+    def broadcast(self, payload: bytes) -> None:
+        for websocket, queue in list(self.active.items()):
+            try:
+                queue.put_nowait(payload)
+            except asyncio.QueueFull:
+                # A backed-up client must not hold ticks back from everyone else
+                logger.warning("WebSocket client fell behind, dropping it")
+                self._drop(websocket)
+
+manager = ConnectionManager()
+
+# Single Angel One streaming subscription shared by all clients
+class MarketFeed:
+    EXCHANGE_TYPES = {"NSE": 1, "NFO": 2, "BSE": 3}
+    LTP_MODE = 1
+    ERROR_PAYLOAD = orjson.dumps({"error": "Failed to fetch market data"})
+
+    def __init__(self, auth: AngelOneAuth, manager: ConnectionManager,
+                 exchange: str = "NSE", tradingsymbol: str = "RELIANCE-EQ", symboltoken: str = "738561"):
+        self.auth = auth
+        self.manager = manager
+        self.exchange = exchange
+        self.tradingsymbol = tradingsymbol
+        self.symboltoken = symboltoken
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.sws: Optional[SmartWebSocketV2] = None
+        self._thread: Optional[threading.Thread] = None
+        self._outbox: asyncio.Queue = asyncio.Queue()
+        self._pump_task: Optional[asyncio.Task] = None
+        self._publish_error_logged_at = float("-inf")
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        self._pump_task = loop.create_task(self._pump())
+        self.sws = SmartWebSocketV2(self.auth.jwt_token, self.auth.api_key, self.auth.user_id, self.auth.feed_token)
+        self.sws.on_open = self._on_open
+        self.sws.on_data = self._on_data
+        self.sws.on_error = self._on_error
+        self.sws.on_close = self._on_close
+        # SmartWebSocketV2.connect() blocks, so it gets its own thread
+        self._thread = threading.Thread(target=self.sws.connect, name="market-feed", daemon=True)
+        self._thread.start()
+
+    async def stop(self) -> None:
+        # Task.cancel is not thread-safe, so cancel on the loop and only block in a thread
+        if self._pump_task:
+            self._pump_task.cancel()
+        await asyncio.to_thread(self._close)
+
+    def _close(self) -> None:
+        if self.sws:
+            self.sws.close_connection()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def is_alive(self) -> bool:
+        """False once SmartWebSocketV2.connect() has given up and its thread exited."""
+        return self._thread is not None and self._thread.is_alive()
+
+    def _on_open(self, wsapp) -> None:
+        token_list = [{"exchangeType": self.EXCHANGE_TYPES[self.exchange], "tokens": [self.symboltoken]}]
+        self.sws.subscribe("ltpfeed", self.LTP_MODE, token_list)
+        logger.info(f"Subscribed to live LTP feed for {self.tradingsymbol}")
+
+    def _on_data(self, wsapp, message) -> None:
+        if "last_traded_price" not in message:
+            return
+        market_data = {
+            "exchange": self.exchange,
+            "tradingSymbol": self.tradingsymbol,
+            "symbolToken": self.symboltoken,
+            "ltp": message["last_traded_price"] / 100  # Feed prices are in paise
+        }
+        # Encode once per tick: JSON bytes for every client, compact MessagePack for Redis
+        self.loop.call_soon_threadsafe(
+            self._outbox.put_nowait, (orjson.dumps(market_data), msgpack.packb(market_data))
+        )
+
+    def _on_error(self, wsapp, error) -> None:
+        logger.error(f"Market Feed Error: {error}")
+        self.loop.call_soon_threadsafe(self._outbox.put_nowait, (self.ERROR_PAYLOAD, None))
+
+    async def _pump(self) -> None:
+        """Deliver ticks in order, over Pub/Sub when Redis is up so every worker sees them."""
+        while True:
+            payload, packed = await self._outbox.get()
+            if not redis_client:
+                self.manager.broadcast(payload)
+                continue
+            if packed:
+                redis_write_queue.put_nowait(("market_data", packed))
+            try:
+                await redis_client.publish(FEED_CHANNEL, payload)
+            except redis.RedisError as e:
+                # Keep this worker's own clients fed while Pub/Sub is down
+                self.manager.broadcast(payload)
+                now = time.monotonic()
+                if now - self._publish_error_logged_at >= PUBLISH_ERROR_LOG_INTERVAL:
+                    self._publish_error_logged_at = now
+                    logger.error(f"Tick Publish Error: {e}. Serving local clients only")
+
+    def _on_close(self, wsapp) -> None:
+        logger.info("Market feed connection closed")
+
+async def redis_writer():
+    """Drain queued Redis writes and execute each batch in one pipelined round trip."""
+    while True:
+        await asyncio.sleep(REDIS_FLUSH_INTERVAL)
+        batch = {}
+        while not redis_write_queue.empty() and len(batch) < REDIS_BATCH_SIZE:
+            key, value = redis_write_queue.get_nowait()
+            batch[key] = value  # Later ticks for the same key supersede earlier ones
+        if not batch:
+            continue
+        pipe = redis_client.pipeline(transaction=False)
+        for key, value in batch.items():
+            pipe.set(key, value, ex=REDIS_TTL)
+        try:
+            await pipe.execute()
+        except redis.RedisError as e:
+            logger.error(f"Redis Write Error: {e}")
+
+async def relay_ticks():
+    """Forward ticks published by the feed leader to this worker's clients."""
+    while True:
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(FEED_CHANNEL)
+            async for message in pubsub.listen():
+                manager.broadcast(message["data"])
+        except redis.RedisError as e:
+            logger.error(f"Tick Relay Error: {e}. Resubscribing in {FEED_RETRY_DELAY}s")
+        finally:
+            try:
+                await pubsub.aclose()
+            except redis.RedisError:
+                pass  # Connection is already broken
+        await asyncio.sleep(FEED_RETRY_DELAY)
+
+async def release_feed_leadership():
+    await release_feed_leader(keys=[FEED_LEADER_KEY], args=[WORKER_ID])
+
+async def lead_market_feed():
+    """Hold the broker feed in exactly one worker, taking over if the current leader dies."""
+    global market_feed
+    try:
+        while True:
+            try:
+                if market_feed and not market_feed.is_alive():
+                    # Give up leadership so this or another worker reopens the feed
+                    logger.error("Market feed thread exited, releasing feed leadership")
+                    await market_feed.stop()
+                    market_feed = None
+                    await release_feed_leadership()
+                elif market_feed:
+                    if not await renew_feed_leader(keys=[FEED_LEADER_KEY], args=[WORKER_ID, FEED_LEADER_TTL]):
+                        logger.warning("Lost market feed leadership, closing broker feed")
+                        await market_feed.stop()
+                        market_feed = None
+                elif await redis_client.set(FEED_LEADER_KEY, WORKER_ID, nx=True, ex=FEED_LEADER_TTL):
+                    logger.info(f"Worker {os.getpid()} is now the market feed leader")
+                    market_feed = MarketFeed(auth_client, manager)
+                    market_feed.start(asyncio.get_running_loop())
+            except redis.RedisError as e:
+                logger.error(f"Feed Leader Election Error: {e}")
+            await asyncio.sleep(FEED_LEADER_TTL / 3)
+    finally:
+        if market_feed:
+            try:
+                await release_feed_leadership()
+            except redis.RedisError:
+                pass
+
 # Root endpoint
 @app.get("/")
 async def root():
@@ -234,66 +704,120 @@ async def root():
 @app.websocket("/ws/market_data")
 async def market_data_ws(websocket: WebSocket):
     await websocket.accept()
+    ticks = manager.connect(websocket)
+    watcher = asyncio.create_task(manager.watch(websocket))
+    # Bound once so the per-tick loop does local lookups only
+    next_tick = ticks.get
+    send = websocket.send_bytes
+    wait_for = asyncio.wait_for
     try:
         while True:
-            market_data = auth_client.get_ltp_data("NSE", "RELIANCE-EQ", "738561")
-            if market_data:
-                if redis_client:
-                    redis_client.set("market_data", str(market_data))
-                await websocket.send_json(market_data)
-            else:
-                await websocket.send_json({"error": "Failed to fetch market data"})
-            await asyncio.sleep(1)
+            payload = await next_tick()
+            if payload is None:  # Dropped by the manager or disconnected
+                await manager.close(websocket)
+                break
+            await wait_for(send(payload), WS_SEND_TIMEOUT)
     except WebSocketDisconnect:
         logger.info("WebSocket client disconnected")
+    except asyncio.TimeoutError:
+        logger.warning("WebSocket client stopped reading, closing connection")
+        await manager.close(websocket)
     except Exception as e:
         logger.error(f"WebSocket Error: {e}", exc_info=True)
-        await websocket.close()
+        await manager.close(websocket)
+    finally:
+        watcher.cancel()
+        manager.disconnect(websocket)
 
 @app.get("/market_data")
-async def get_market_data():
+async def get_market_data(request: Request):
     if not redis_client:
         return {"data": "Redis not available, start WebSocket to fetch live data"}
-    data = redis_client.get("market_data")
-    return {"data": data if data else "No data available"}
+    data = await redis_client.get("market_data")
+    if data and "application/msgpack" in request.headers.get("accept", ""):
+        return Response(content=data, media_type="application/msgpack")  # Stored bytes pass straight through
+    return {"data": msgpack.unpackb(data) if data else "No data available"}
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
 
 @app.get("/historical_data")
-async def get_historical():
-    data = auth_client.get_historical_data(
-        exchange="NSE",
-        symboltoken="738561",
-        interval="ONE_MINUTE",
-        fromdate="2025-03-27 09:00",
-        todate="2025-03-27 15:30"  # Adjusted to market close
-    )
-    return {"historical_data": data if data else "No data available"}
+async def get_historical(request: Request):
+    params = {
+        "exchange": "NSE",
+        "symboltoken": "738561",
+        "interval": "ONE_MINUTE",
+        "fromdate": "2025-03-27 09:00",
+        "todate": "2025-03-27 15:30"  # Adjusted to market close
+    }
+    etag_key = "hist:etag:" + hashlib.blake2b(orjson.dumps(params), digest_size=8).hexdigest()
+    if_none_match = request.headers.get("if-none-match")
+
+    # Answer a revalidation straight from the remembered ETag, skipping the fetch and encode
+    if if_none_match and redis_client:
+        try:
+            current = await redis_client.get(etag_key)
+        except redis.RedisError as e:
+            logger.warning(f"ETag lookup failed: {e}")
+            current = None
+        if current and _etag_matches(if_none_match, current.decode()):
+            return Response(status_code=304, headers={"ETag": current.decode()})
+
+    data = await auth_client.get_historical_data(**params)
+    if not data:
+        return {"historical_data": "No data available"}
+    body = orjson.dumps({"historical_data": data}, option=orjson.OPT_SERIALIZE_NUMPY)
+    etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+    if redis_client:
+        try:
+            await redis_client.setex(etag_key, HISTORICAL_ETAG_TTL, etag)
+        except redis.RedisError as e:
+            logger.warning(f"ETag store failed: {e}")
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
 
 @app.get("/order_book")
 async def get_orders():
-    data = auth_client.get_order_book()
+    data = await auth_client.get_order_book()
     return {"order_book": data if data else "No data available"}
 
 @app.get("/profile")
 async def get_user_profile():
-    data = auth_client.get_profile()
+    data = await auth_client.get_profile()
     return {"profile": data if data else "No data available"}
 
+# The demo order never changes, so its request body is encoded once
+PLACE_ORDER_BODY = orjson.dumps({
+    "variety": "NORMAL",
+    "tradingsymbol": "RELIANCE-EQ",
+    "symboltoken": "738561",
+    "transactiontype": "BUY",
+    "exchange": "NSE",
+    "ordertype": "MARKET",
+    "producttype": "INTRADAY",
+    "duration": "DAY",
+    "quantity": "1"
+})
+
 @app.post("/place_order")
 async def place_new_order():
-    order_params = {
-        "variety": "NORMAL",
-        "tradingsymbol": "RELIANCE-EQ",
-        "symboltoken": "738561",
-        "transactiontype": "BUY",
-        "exchange": "NSE",
-        "ordertype": "MARKET",
-        "producttype": "INTRADAY",
-        "duration": "DAY",
-        "quantity": "1"
-    }
-    data = auth_client.place_order(order_params)
+    data = await auth_client.place_order(PLACE_ORDER_BODY)
     return {"order": data if data else "Order placement failed"}
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Workers need the app as an import string; each one runs its own lifespan
+    uvicorn.run(
+        "market_data_service:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=os.cpu_count(),
+        ws_ping_interval=20,
+        ws_ping_timeout=10
+    )